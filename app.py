@@ -1,12 +1,25 @@
+import hashlib
+import io
+import os
+import queue
 import re
-from typing import Dict, Optional, List
+import threading
+from collections import deque
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Sequence, Tuple
 
 import streamlit as st
-from pdf2image import convert_from_bytes
+import pypdfium2 as pdfium
 import pytesseract
 from PIL import Image
+import numpy as np
 import pandas as pd
 
+# Stránky se OCRují paralelně (každá ve vlastním procesu tesseract), proto interní
+# OpenMP vlákna Tesseractu omezíme na 1 – jinak se jádra přetěžují
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 
 # ===== UI & config =====
 st.set_page_config(page_title="OCR skenovaného PDF", layout="wide")
@@ -22,66 +35,189 @@ uploaded_file = st.file_uploader("Nahrajte PDF", type=["pdf"])
 lang = "ces"
 dpi = st.slider("Render DPI (vyšší = ostřejší OCR, ale pomalejší)", 150, 400, 300, 50)
 
+# Tesseract běží jako samostatný proces, takže na paralelní OCR stránek stačí vlákna;
+# s OMP_THREAD_LIMIT=1 vytíží každý proces tesseract jedno jádro. Workerů je tolik, kolik
+# jader má k dispozici tento proces (os.cpu_count() v kontejneru vrací jádra hostitele),
+# nejvýš však 4 – počet workerů určuje i to, kolik vykreslených stránek je najednou v paměti
+_CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+OCR_WORKERS = min(_CPU_COUNT, 4)
+# strop delší strany stránky v px (A4 při max. DPI slideru); větší formáty se zmenší,
+# aby OCR a zobrazení netahaly zbytečně obří bitmapy
+MAX_LONG_EDGE_PX = round(297 / 25.4 * 400)
+# --psm 6 = jednolitý blok textu; lab. protokoly jsou řádkové tabulky a výchozí
+# automatická segmentace je rozsekává do sloupců
+TESSERACT_CONFIG = "--psm 6"
+# kolik stránek smí renderovací vlákno vykreslit dopředu, než na ně OCR dojde
+RENDER_PREFETCH = 2
+# stránka s textovou vrstvou o více než tolika nebílých znacích (hybridní sken) se neOCRuje
+TEXT_LAYER_MIN_CHARS = 200
 
-# ===== Helpers =====
-@st.cache_data(show_spinner=False)
-def pdf_to_images_from_bytes(file_bytes: bytes, dpi_val: int = 300) -> List[Image.Image]:
-    """Render PDF na seznam PIL obrázků přes pdf2image (vyžaduje Poppler)."""
-    return convert_from_bytes(file_bytes, dpi=dpi_val)
 
-def ocr_image(img: Image.Image, lang_code: str) -> str:
-    """OCR přes Tesseract (bez cache kvůli nehashovatelným objektům)."""
-    return pytesseract.image_to_string(img, lang=lang_code)
+# ===== Helpers =====
+@st.cache_resource
+def _pdfium_lock() -> threading.Lock:
+    """PDFium není thread-safe – jeden zámek sdílený všemi relacemi aplikace."""
+    return threading.Lock()
+
+# získá se ve vlákně skriptu; renderovací vlákno na pozadí pak st.* nevolá
+PDFIUM_LOCK = _pdfium_lock()
+
+@st.cache_resource(max_entries=2)
+def open_pdf(pdf_hash: str, _file_bytes: bytes) -> pdfium.PdfDocument:
+    """Otevřený PdfDocument sdílený mezi reruny; klíčem je hash obsahu (bajty se nehashují)."""
+    with PDFIUM_LOCK:
+        return pdfium.PdfDocument(_file_bytes)
+
+def iter_pdf_pages(pdf: pdfium.PdfDocument, dpi_val: int = 300) -> Iterator[Tuple[Image.Image, str]]:
+    """Postupně renderuje stránky PDF na šedotónové PIL obrázky přes pypdfium2 (PDFium přímo v procesu)
+    a vrací je spolu s případnou vloženou textovou vrstvou stránky."""
+    with PDFIUM_LOCK:
+        n_pages = len(pdf)
+    for i in range(n_pages):
+        with PDFIUM_LOCK:
+            page = pdf[i]
+            w_pt, h_pt = page.get_size()
+            # měřítko z DPI, ale delší strana nejvýš MAX_LONG_EDGE_PX
+            scale = min(dpi_val / 72.0, MAX_LONG_EDGE_PX / max(w_pt, h_pt))
+            # OCR barvy nepotřebuje: 8bit šedá bitmapa je třetinová proti RGB.
+            # rev_byteorder: případný barevný render je rovnou RGB, to_pil() jen obalí buffer
+            img = page.render(scale=scale, grayscale=True, rev_byteorder=True).to_pil()
+            textpage = page.get_textpage()
+            text_layer = textpage.get_text_range().replace("\r\n", "\n")
+            textpage.close()
+            page.close()
+        yield img, text_layer
+
+def iter_pdf_pages_prefetched(pdf: pdfium.PdfDocument, dpi_val: int = 300) -> Iterator[Tuple[Image.Image, str]]:
+    """Jako iter_pdf_pages, ale render běží ve vlákně na pozadí nejvýš RENDER_PREFETCH stran dopředu."""
+    q: queue.Queue = queue.Queue(maxsize=RENDER_PREFETCH)
+    stop = threading.Event()
+
+    def producer() -> None:
+        try:
+            for item in iter_pdf_pages(pdf, dpi_val):
+                if stop.is_set():
+                    return
+                q.put(item)
+        except Exception as e:
+            q.put(e)
+        finally:
+            q.put(None)
 
-def _find_first(patterns: List[re.Pattern], text: str) -> Optional[str]:
+    worker = threading.Thread(target=producer, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # při předčasném ukončení uvolni producenta, který může čekat na místo ve frontě
+        stop.set()
+        while worker.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def ocr_image(img: Image.Image, lang_code: str, config: str = "") -> str:
+    """OCR přes Tesseract bez cache – výkonná část za _ocr_cached."""
+    # pytesseract předává obrázek přes dočasný soubor ve formátu img.format (výchozí PNG);
+    # nekomprimovaný PPM ušetří zbytečnou PNG kompresi a dekompresi celé stránky
+    if img.format is None and img.mode in ("1", "L", "RGB"):
+        img.format = "PPM"
+    return pytesseract.image_to_string(img, lang=lang_code, config=config)
+
+# jen v paměti: OCR text obsahuje osobní údaje pacientů (jméno, RČ, adresa), na disk nepatří
+@st.cache_data(show_spinner=False, max_entries=512)
+def _ocr_cached(page_hash: str, lang_code: str, config: str, _img: Image.Image) -> str:
+    """OCR s cache; klíčem je hash obsahu stránky, jazyk a konfigurace (obrázek samotný se nehashuje)."""
+    return ocr_image(_img, lang_code, config)
+
+def hash_page(img: Image.Image) -> str:
+    """Hash obsahu bitmapy stránky – klíč OCR cache i odhalení duplicitních stran."""
+    return hashlib.blake2b(img.tobytes(), digest_size=16).hexdigest()
+
+_TRAIL_RE = re.compile(r"[,\s]+$")
+_HSPACE_RE = re.compile(r"[ \t]+")
+
+def _find_first(patterns: Sequence[re.Pattern], text: str) -> Optional[str]:
     for pat in patterns:
         m = pat.search(text)
         if m:
-            return re.sub(r"[,\s]+$", "", m.group(1).strip())
+            return _TRAIL_RE.sub("", m.group(1).strip())
     return None
 
+# vzory identifikačních údajů; zkouší se v pořadí, platí první shoda
+_JMENO_PATS = (
+    re.compile(r"Jméno\s*pacienta[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
+    #re.compile(r"Pacient(?:ka)?[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
+    #re.compile(r"Jméno[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
+)
+_ZDR_POJ_PATS = (
+    re.compile(r"Zdravotní\s+pojišťovna[:\s]*([^\n,]+)", re.IGNORECASE),
+    #re.compile(r"ZP[:\s]*([^\n,]+)", re.IGNORECASE),
+    #re.compile(r"Pojišťovna[:\s]*([^\n,]+)", re.IGNORECASE),
+)
+_RC_PATS = (
+    re.compile(r"Rodné\s*číslo[:\s]*([0-9]{2,6}\s*/?\s*[0-9]{3,4})", re.IGNORECASE),
+    #re.compile(r"RČ[:\s]*([0-9]{2,6}\s*/?\s*[0-9]{3,4})", re.IGNORECASE),
+)
+_ADRESA_PATS = (
+    # pouze přesně "Adresa:" na začátku řádku (s volitelnými mezerami)
+    re.compile(r"^\s*Adresa\s*:\s*([^\n]+)", re.IGNORECASE | re.MULTILINE),
+    re.compile(r"^\s*Bydliště\s*:\s*([^\n]+)", re.IGNORECASE | re.MULTILINE),
+)
+_MUDR_PATS = (
+    re.compile(r"(?:MUDr\.?|MUDR\.?)\s*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)"),
+)
+
 def extract_id_fields(text: str) -> Dict[str, Optional[str]]:
     """Extrahuje jméno pacienta, ZP, RČ, adresu a lékaře (MUDr.)."""
-    norm = re.sub(r"[ \t]+", " ", text)
-
-    jmeno_pats = [
-        re.compile(r"Jméno\s*pacienta[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
-        #re.compile(r"Pacient(?:ka)?[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
-        #re.compile(r"Jméno[:\s]*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)", re.IGNORECASE),
-    ]
-    zdr_poj = [
-        re.compile(r"Zdravotní\s+pojišťovna[:\s]*([^\n,]+)", re.IGNORECASE),
-        #re.compile(r"ZP[:\s]*([^\n,]+)", re.IGNORECASE),
-        #re.compile(r"Pojišťovna[:\s]*([^\n,]+)", re.IGNORECASE),
-    ]
-    rc_patterns = [
-        re.compile(r"Rodné\s*číslo[:\s]*([0-9]{2,6}\s*/?\s*[0-9]{3,4})", re.IGNORECASE),
-        #re.compile(r"RČ[:\s]*([0-9]{2,6}\s*/?\s*[0-9]{3,4})", re.IGNORECASE),
-    ]
-    adresa_patterns = [
-        # pouze přesně "Adresa:" na začátku řádku (s volitelnými mezerami)
-        re.compile(r"^\s*Adresa\s*:\s*([^\n]+)", re.IGNORECASE | re.MULTILINE),
-        re.compile(r"^\s*Bydliště\s*:\s*([^\n]+)", re.IGNORECASE | re.MULTILINE),
-    ]
-    mudr_patterns = [
-        re.compile(r"(?:MUDr\.?|MUDR\.?)\s*([A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ][^\n,]+)"),
-    ]
+    norm = _HSPACE_RE.sub(" ", text)
 
     return {
-        "Jméno pacienta": _find_first(jmeno_pats, norm),
-        "Zdravotní pojišťovna": _find_first(zdr_poj, norm),
-        "Rodné číslo": _find_first(rc_patterns, norm),
-        "Adresa": _find_first(adresa_patterns, norm),
-        "Doktor (MUDr.)": _find_first(mudr_patterns, norm),
+        "Jméno pacienta": _find_first(_JMENO_PATS, norm),
+        "Zdravotní pojišťovna": _find_first(_ZDR_POJ_PATS, norm),
+        "Rodné číslo": _find_first(_RC_PATS, norm),
+        "Adresa": _find_first(_ADRESA_PATS, norm),
+        "Doktor (MUDr.)": _find_first(_MUDR_PATS, norm),
     }
 
-def _to_float_maybe(val: str) -> Optional[float]:
-    s = val.strip().replace(" ", "").replace("\u202f", "").replace("\xa0", "")
-    s = s.replace(",", ".")
-    try:
-        return float(s)
-    except:
-        return None
+# mezery (vč. nezlomitelných) pryč, desetinná čárka -> tečka; jeden průchod místo řetězu replace
+_NUM_TRANS = str.maketrans({" ": None, "\u202f": None, "\xa0": None, ",": "."})
+
+# lab. řádek: kód, název, hodnota, jednotka, (rozsah); hledá se přes finditer v celém
+# textu s už sjednocenými mezerami, proto jen [ ] místo \s (nesmí přeskočit na další řádek)
+_LAB_LINE_RE = re.compile(
+    r"""^
+    (?P<kod>\d{3,6})[ ]
+    (?P<nazev>[A-Za-zÁ-Žá-ž0-9\.\-/% ]+?)[ ]
+    (?P<hodnota_raw>
+        (?:[<>]*[ ]?[+-]*[ ]?\d+(?:[.,]\d+)?)|
+        (?:neg|poz|poz\.)|
+        (?:trace|stopa|stop\.)
+    )
+    [ >]*                        # volitelné >> / <<
+    (?P<jednotka>[^\s(]+)?       # jednotka
+    [ ]?
+    (?:\((?P<rozsah>[^)\n]*)\))?  # (a - b)
+    [^\n]*                       # zbytek řádku (kvůli >> / << za rozsahem)
+    """,
+    re.IGNORECASE | re.MULTILINE | re.VERBOSE,
+)
+_ARROW_AFTER_VAL_RE = re.compile(r"\s*(>>|<<)\s*")
+# rozsah "a - b": první číslo, za ním hned oddělovač (pomlčka/vlnovka, případně s OCR šumem
+# jako "1 -- 2", "1 - x 2", nebo "až") a druhé číslo; znaménko záporné meze zůstává u čísla
+# (-2.5 - 2.5, -3--1), takže "136-145" už nedává horní mez -145
+_RANGE_RE = re.compile(
+    r"^\D*?([-+]?\d+(?:\.\d+)?)(?:\s*[-~–—]\D*?|\s+až\s+)(?=[-+]?\d)([-+]?\d+(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+_RANGE_NUM_RE = re.compile(r"([-+]?\d+(?:\.\d+)?)")
 
 def parse_labs(text: str) -> pd.DataFrame:
     """
@@ -91,76 +227,62 @@ def parse_labs(text: str) -> pd.DataFrame:
     03364 Glukóza neg arb.j. (0 - 1)
     -> kód, název, hodnota, jednotka, norma_min, norma_max, poznámka
     """
-    rows = []
-    line_re = re.compile(
-        r"""^\s*
-        (?P<kod>\d{3,6})\s+
-        (?P<nazev>[A-Za-zÁ-Žá-ž0-9\.\-/%\s]+?)\s+
-        (?P<hodnota_raw>
-            (?:[<>]*\s*[+-]*\s*\d+(?:[.,]\d+)?)|
-            (?:neg|poz|poz\.)|
-            (?:trace|stopa|stop\.)
+    # sjednocení mezer po řádcích (str.split je tu rychlejší než regex nad celým textem),
+    # pak jeden finditer přes celý text – hledání řádků běží v C regex enginu
+    norm = "\n".join([" ".join(line.split()) for line in text.splitlines()])
+    zaznamy = [
+        (mm.group(0), *mm.group("kod", "nazev", "hodnota_raw", "jednotka", "rozsah"))
+        for mm in _LAB_LINE_RE.finditer(norm)
+    ]
+    if zaznamy:
+        m = pd.DataFrame(
+            zaznamy, columns=["radek", "kod", "nazev", "hodnota_raw", "jednotka", "rozsah"], dtype=object
+        ).fillna("")
+        lines = m["radek"]
+        hodnota_raw = m["hodnota_raw"].str.strip()
+        jednotka = m["jednotka"].str.strip()
+        rozsah = m["rozsah"].str.strip()
+
+        hodnota_clean = hodnota_raw.str.replace(_ARROW_AFTER_VAL_RE, "", regex=True).str.strip("<> ")
+        hodnota_num = pd.to_numeric(
+            hodnota_clean.str.translate(_NUM_TRANS).str.strip(), errors="coerce"
+        ).astype(float)
+        hodnota_out = hodnota_num.astype(str).where(hodnota_num.notna(), hodnota_clean)
+
+        # obě meze jedním extract; bez rozpoznaného oddělovače jako dřív první dvě čísla
+        rozsah_n = rozsah.str.replace(",", ".", regex=False)
+        meze = rozsah_n.str.extract(_RANGE_RE)
+        nums = rozsah_n.str.findall(_RANGE_NUM_RE)
+        nerozdeleno = meze[0].isna()
+        ma_dve = nums.str.len() >= 2
+        dolni = meze[0].mask(nerozdeleno, nums.str[0].where(ma_dve))
+        horni = meze[1].mask(nerozdeleno, nums.str[1].where(ma_dve))
+        norma_min = pd.to_numeric(dolni, errors="coerce").astype(float)
+        norma_max = pd.to_numeric(horni, errors="coerce").astype(float)
+
+        hodnota_lower = hodnota_raw.str.lower()
+        pozn = np.select(
+            [
+                lines.str.contains(">>", regex=False),
+                lines.str.contains("<<", regex=False),
+                hodnota_lower.str.contains("neg", regex=False),
+                hodnota_lower.str.contains("poz", regex=False),
+            ],
+            ["výrazně zvýšeno", "výrazně sníženo", "negativní", "pozitivní"],
+            default=None,
         )
-        [\s>]*                       # volitelné >> / <<
-        (?P<jednotka>[^\s(]+)?       # jednotka
-        \s*
-        (?:\((?P<rozsah>[^)]*)\))?   # (a - b)
-        """,
-        re.IGNORECASE | re.VERBOSE,
-    )
-    arrow_after_val = re.compile(r"\s*(>>|<<)\s*")
-
-    for raw_line in text.splitlines():
-        line = " ".join(raw_line.strip().split())
-        if not line:
-            continue
-        m = line_re.match(line)
-        if not m:
-            continue
-
-        kod = m.group("kod")
-        nazev = (m.group("nazev") or "").strip(" :;.-")
-        hodnota_raw = (m.group("hodnota_raw") or "").strip()
-        jednotka = (m.group("jednotka") or "").strip()
-        rozsah = (m.group("rozsah") or "").strip()
-
-        pozn = ""
-        hodnota_clean = arrow_after_val.sub("", hodnota_raw).strip("<> ")
-        hodnota_num = _to_float_maybe(hodnota_clean)
-        hodnota_out = str(hodnota_num) if hodnota_num is not None else hodnota_clean
-
-        norma_min = norma_max = None
-        if rozsah:
-            r = rozsah.replace(",", ".")
-            nums = re.findall(r"[-+]?\d+(?:\.\d+)?", r)
-            if len(nums) >= 2:
-                norma_min = _to_float_maybe(nums[0])
-                norma_max = _to_float_maybe(nums[1])
-
-        if ">>" in line:
-            pozn = "výrazně zvýšeno"
-        elif "<<" in line:
-            pozn = "výrazně sníženo"
-        elif "neg" in hodnota_raw.lower():
-            pozn = "negativní"
-        elif "poz" in hodnota_raw.lower():
-            pozn = "pozitivní"
-
-        rows.append(
+
+        df = pd.DataFrame(
             {
-                "kód": kod,
-                "název": nazev,
+                "kód": m["kod"],
+                "název": m["nazev"].str.strip(" :;.-"),
                 "hodnota": hodnota_out,
-                "jednotka": jednotka or None,
+                "jednotka": jednotka.where(jednotka != "", None),
                 "norma_min": norma_min,
                 "norma_max": norma_max,
-                "poznámka": pozn or None,
+                "poznámka": pozn,
             }
         )
-
-    if rows:
-        df = pd.DataFrame(rows)
-        df["název"] = df["název"].str.replace(r"\s+", " ", regex=True).str.strip()
         with pd.option_context("mode.copy_on_write", True):
             df["kód_num"] = pd.to_numeric(df["kód"], errors="coerce")
             df = df.sort_values(["kód_num", "název"]).drop(columns=["kód_num"])
@@ -172,34 +294,72 @@ def parse_labs(text: str) -> pd.DataFrame:
 if uploaded_file:
     file_bytes = uploaded_file.read()
 
-    with st.spinner("Vykresluji stránky PDF…"):
-        pages = pdf_to_images_from_bytes(file_bytes, dpi_val=dpi)
+    # PDF se parsuje jen jednou; reruny (slider DPI, stažení) sdílí otevřený dokument
+    pdf = open_pdf(hashlib.blake2b(file_bytes, digest_size=16).hexdigest(), file_bytes)
+    with PDFIUM_LOCK:
+        n_pages = len(pdf)
 
-    vsechny_texty = []           # [(index_strany, text)]
-    vsechny_texty_only = []      # [text_bez_hlavicek] pro join
+    full_text_buf = io.StringIO()               # texty stran bez hlaviček pro extrakci
+    full_text_with_headers_buf = io.BytesIO()   # texty stran s hlavičkami ke stažení (UTF-8)
     vsechny_laby_per_page = []   # případně pro debug
 
-    for i, page_img in enumerate(pages, start=1):
+    progress = st.progress(0.0, text=f"OCR 0/{n_pages} stran…")
+
+    def zobraz_stranku(i: int, page_img: Image.Image, fut: Future, z_vrstvy: bool) -> None:
+        text = fut.result()
+
         st.markdown(f"## Stránka {i}")
         st.image(page_img, caption=f"Stránka {i}", use_container_width=True)
+        if z_vrstvy:
+            st.caption("Text převzat z textové vrstvy PDF (bez OCR).")
 
-        with st.spinner(f"OCR stránka {i}/{len(pages)}…"):
-            text = ocr_image(page_img, lang_code=lang)
-
-        # uložení textu
-        vsechny_texty.append((i, text))
-        vsechny_texty_only.append(text)
+        # uložení textu (průběžně, bez seznamu všech stran)
+        if i > 1:
+            full_text_buf.write("\n\n")
+            full_text_with_headers_buf.write(b"\n\n")
+        full_text_buf.write(text)
+        full_text_with_headers_buf.write(f"--- Stránka {i} ---\n{text.strip()}".encode("utf-8"))
 
         # zobraz jen surový text této stránky (na přání)
         with st.expander("Zobrazit surový text (OCR)"):
-            st.text_area("Text", text, height=220)
+            # popisek s číslem strany: stejné texty dvou stran nekolidují a widget bez key
+            # se při změně textu (DPI, jiné PDF) vytvoří znovu, takže neukazuje starý obsah
+            st.text_area(f"Text (stránka {i})", text, height=220)
 
         st.divider()
+        progress.progress(i / n_pages, text=f"OCR {i}/{n_pages} stran…")
+
+    # Render → OCR → zobrazení jako pipeline: render běží ve vlastním vlákně, OCR v poolu
+    # a hlavní vlákno zobrazuje hotové stránky v pořadí. V paměti je najednou nejvýš
+    # RENDER_PREFETCH + OCR_WORKERS + 1 vykreslených stránek.
+    rozpracovane = deque()   # [(číslo_strany, obrázek, future, z_vrstvy)] v pořadí stran
+    ocr_podle_hashe: Dict[str, Future] = {}   # stejné strany (prázdné, opakované hlavičky) jen jednou
+    with ThreadPoolExecutor(max_workers=OCR_WORKERS) as ex, \
+            closing(iter_pdf_pages_prefetched(pdf, dpi_val=dpi)) as stranky:
+        for i, (page_img, text_layer) in enumerate(stranky, start=1):
+            # počítají se jen nebílé znaky – neviditelné vrstvy skenerů bývají hlavně mezery a konce řádků
+            z_vrstvy = len("".join(text_layer.split())) > TEXT_LAYER_MIN_CHARS
+            if z_vrstvy:
+                # stránka už text obsahuje – OCR by byla zbytečná práce
+                fut = Future()
+                fut.set_result(text_layer)
+            else:
+                page_hash = hash_page(page_img)
+                fut = ocr_podle_hashe.get(page_hash)
+                if fut is None:
+                    fut = ex.submit(_ocr_cached, page_hash, lang, TESSERACT_CONFIG, page_img)
+                    ocr_podle_hashe[page_hash] = fut
+            rozpracovane.append((i, page_img, fut, z_vrstvy))
+            if len(rozpracovane) > OCR_WORKERS:
+                zobraz_stranku(*rozpracovane.popleft())
+        while rozpracovane:
+            zobraz_stranku(*rozpracovane.popleft())
+    progress.empty()
 
     # ===== EXTRAKCE NA KONCI Z CELÉHO TEXTU =====
     st.markdown("## Extrakce z celého dokumentu")
 
-    full_text = "\n\n".join(vsechny_texty_only)
+    full_text = full_text_buf.getvalue()
 
     # 1) Identifikační údaje (celý dokument)
     st.markdown("### Identifikační údaje")
@@ -218,9 +378,12 @@ if uploaded_file:
     df_all_labs = parse_labs(full_text)
     if not df_all_labs.empty:
         st.dataframe(df_all_labs, use_container_width=True)
+        # CSV rovnou do bajtového bufferu – bez mezikroku přes str
+        csv_buf = io.BytesIO()
+        df_all_labs.to_csv(csv_buf, index=False, encoding="utf-8-sig")
         st.download_button(
             "⬇️ Stáhnout všechny laby (CSV)",
-            df_all_labs.to_csv(index=False).encode("utf-8-sig"),
+            csv_buf.getvalue(),
             file_name="lab_vsechny.csv",
             mime="text/csv",
         )
@@ -228,10 +391,12 @@ if uploaded_file:
         st.info("V celém dokumentu se nepodařilo bezpečně rozpoznat standardní laboratorní řádky.")
 
     # 3) Stažení kompletního OCR textu (pro audit/debug)
-    full_text_with_headers = "\n\n".join(
-        [f"--- Stránka {i} ---\n{t.strip()}" for i, t in vsechny_texty]
+    st.download_button(
+        "⬇️ Stáhnout veškerý OCR text",
+        full_text_with_headers_buf.getvalue(),
+        file_name="ocr_text.txt",
+        mime="text/plain",
     )
-    st.download_button("⬇️ Stáhnout veškerý OCR text", full_text_with_headers, file_name="ocr_text.txt")
 
     # Diagnostika Tesseractu
     with st.expander("Diagnostika"):
@@ -239,6 +404,7 @@ if uploaded_file:
             ver = pytesseract.get_tesseract_version()
             st.write(f"Verze Tesseract: {ver}")
             st.write(f"Použité jazyky: {lang}")
+            st.write(f"Konfigurace: {TESSERACT_CONFIG}")
         except Exception as e:
             st.error(f"Tesseract nenalezen: {e}")
 